@@ -1,9 +1,89 @@
 import streamlit as st
+import csv
 import os
+import shutil
+from collections import defaultdict, deque
 import pandas as pd
-from google import generativeai as genai
+import hashlib
+import httpx
 import json
+import logging
+import multiprocessing
+import sqlite3
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import closing
+from diskcache import Cache
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types as genai_types
+from pdf_text import extract_pdf_text
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+# Retry and model-escalation details go to the console at INFO level. Streamlit
+# re-executes this script on every rerun, so the handler is only added once.
+logger = logging.getLogger(__name__)
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# Transient Gemini API errors (timeouts, rate limits, overload) that are worth retrying,
+# matching the HTTP status codes the google-genai SDK itself treats as transient
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_NETWORK_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+MAX_ATTEMPTS = 6
+MAX_RETRY_WAIT = 120  # seconds; caps both backoff and server-requested delays
+
+# Bump when the prompt changes so cached responses from the old prompt are not reused
+PROMPT_VERSION = "v3"
+CACHE_DIR = "./.astral_cache"
+CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
+# Number of most recent rows shown in the live preview while extracting
+LIVE_PREVIEW_ROWS = 20
+# Redraw the live preview at most every N rows or T seconds; rebuilding it per row dominates large runs
+LIVE_PREVIEW_EVERY_ROWS = 25
+LIVE_PREVIEW_INTERVAL = 1.0
+
+# Runs with fewer files than this read PDF text on a thread instead of starting worker processes
+TEXT_POOL_MIN_FILES = 8
+
+# Files are copied and hashed in chunks of this size to keep memory flat
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Per-file job status, kept on disk so an interrupted run can be resumed
+STATE_DB = "./.astral_state.db"
+
+# Streamlit re-executes this script on every rerun, so shared objects are created
+# once per process through st.cache_resource rather than as plain globals
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    # Extraction results keyed by file content, fields, model and prompt version
+    return Cache(CACHE_DIR)
+
+@st.cache_resource(show_spinner=False)
+def get_stats():
+    # Counters shown in the sidebar, shared by all worker threads
+    return {"api_calls": 0, "retries": 0, "cache_hits": 0, "cache_misses": 0}, threading.Lock()
+
+response_cache = get_response_cache()
+stats, stats_lock = get_stats()
+
+# Upper bound of the Concurrency slider
+MAX_CONCURRENCY = 32
+
+# Models from cheapest to most capable; a file whose response cannot be parsed or
+# has no fields found is retried with the next model up
+MODEL_TIERS = ["gemini-1.5-flash-8b", "gemini-1.5-flash", "gemini-1.5-pro"]
+
+# Batch mode submits one asynchronous job at a lower price; small runs stay interactive
+BATCH_MIN_FILES = 10
+BATCH_POLL_INTERVAL = 30  # seconds
+BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
 
 # Available fields for extraction
 AVAILABLE_FIELDS = {
@@ -15,45 +95,522 @@ AVAILABLE_FIELDS = {
     "payment_credited_date": "Payment Credited Date (e.g., 'Payment Date', 'Credit Date', 'Transaction Date')"
 }
 
-def extract_structured_data(file_path: str, model, selected_fields: list):
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, genai_errors.APIError):
+        return error.code in RETRYABLE_STATUS_CODES
+    return isinstance(error, RETRYABLE_NETWORK_ERRORS)
+
+def parse_seconds(value):
+    # Parse a Retry-After header ("30") or a RetryInfo delay ("30s", "1.5s"); None if unusable
     try:
-        # Generate prompt based on selected fields
-        field_descriptions = [f"{field}: {AVAILABLE_FIELDS[field]}" for field in selected_fields]
-        prompt = (
-            f"Extract the following details from the provided PDF and return ONLY a valid JSON response:\n"
-            f"{'; '.join(field_descriptions)}\n"
-            "Handle variations in field names as indicated. For any field not found, use 'Not Found' as the value.\n"
-            "IMPORTANT: Your response must contain ONLY the JSON object, without any additional text or markdown formatting."
-        )
-        
-        # Process the file
-        response = model.generate_content(
-            [
-                prompt,
-                genai.upload_file(file_path)
-            ]
-        )
-        
-        # Clean the response text
-        response_text = response.text.strip()
-        
-        # Sometimes Gemini adds markdown formatting, so we need to remove it
-        if response_text.startswith("```json"):
-            response_text = response_text[7:-3].strip()
-        elif response_text.startswith("```"):
-            response_text = response_text[3:-3].strip()
-        
-        # Parse JSON response
-        extracted_data = json.loads(response_text)
-        return extracted_data
+        return max(float(str(value).strip().rstrip("s")), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def server_retry_delay(error: BaseException):
+    # How long the server asked us to wait, from the Retry-After header or the
+    # google.rpc.RetryInfo entry in the error body; None if it did not say
+    if not isinstance(error, genai_errors.APIError):
+        return None
+    headers = getattr(error.response, "headers", None) or {}
+    delay = parse_seconds(headers.get("retry-after"))
+    if delay is not None:
+        return delay
+    body = error.details if isinstance(error.details, dict) else {}
+    body = body.get("error") if isinstance(body.get("error"), dict) else body
+    for detail in body.get("details") or []:
+        if isinstance(detail, dict) and detail.get("@type", "").endswith("google.rpc.RetryInfo"):
+            return parse_seconds(detail.get("retryDelay"))
+    return None
+
+backoff = wait_random_exponential(multiplier=1, max=MAX_RETRY_WAIT)
+
+def wait_for_retry(retry_state) -> float:
+    # Honor the server's requested delay when there is one, otherwise back off with jitter
+    delay = server_retry_delay(retry_state.outcome.exception())
+    return min(delay, MAX_RETRY_WAIT) if delay is not None else backoff(retry_state)
+
+def make_retryer():
+    # Retry transient API and network errors; anything else fails immediately
+    return Retrying(
+        wait=wait_for_retry,
+        stop=stop_after_attempt(MAX_ATTEMPTS),
+        retry=retry_if_exception(is_retryable),
+        reraise=True,
+    )
+
+def generate_with_retry(client, model_name: str, contents, generation_config=None):
+    retryer = make_retryer()
+    try:
+        return retryer(client.models.generate_content, model=model_name, contents=contents, config=generation_config)
+    finally:
+        attempts = retryer.statistics.get("attempt_number", 1)
+        with stats_lock:
+            stats["api_calls"] += 1
+            stats["retries"] += attempts - 1
+        if attempts > 1:
+            logger.info("Gemini call finished on attempt %d of %d", attempts, MAX_ATTEMPTS)
+
+def cache_key(file_hash: str, model_name: str, selected_fields: tuple) -> str:
+    return "|".join([file_hash, ",".join(sorted(selected_fields)), model_name, PROMPT_VERSION])
+
+def get_uploaded_file(client, file_path: str, file_hash: str, upload_cache: dict):
+    # Uploaded files live on the Gemini File API for 48 hours, so reuse the handle
+    # for identical content instead of uploading the PDF again. upload_cache must
+    # belong to the same API key as client, since files are private to a project.
+    cached_file = upload_cache.get(file_hash)
+    if cached_file is not None:
+        try:
+            if client.files.get(name=cached_file.name).state.name == "ACTIVE":
+                return cached_file
+        except genai_errors.ClientError:
+            pass
+    uploaded_file = client.files.upload(file=file_path)
+    upload_cache[file_hash] = uploaded_file
+    return uploaded_file
+
+@st.cache_resource(show_spinner=False)
+def get_client(api_key: str):
+    # One client per API key, shared by every session and worker thread using that key.
+    # Nothing is configured globally, so sessions with different keys never mix. Its
+    # HTTP/2 keep-alive pool is large enough for the maximum Concurrency setting, so
+    # parallel calls reuse open connections instead of repeating TLS handshakes.
+    return genai.Client(
+        api_key=api_key,
+        http_options=genai_types.HttpOptions(client_args={
+            "http2": True,
+            "limits": httpx.Limits(max_connections=MAX_CONCURRENCY * 2, max_keepalive_connections=MAX_CONCURRENCY * 2),
+        }),
+    )
+
+@st.cache_data(show_spinner=False)
+def build_prompt(selected_fields: tuple) -> str:
+    # Generate prompt based on selected fields
+    field_descriptions = [f"{field}: {AVAILABLE_FIELDS[field]}" for field in selected_fields]
+    return (
+        f"Extract the following details from the provided PDF (given either as a file or as its extracted text):\n"
+        f"{'; '.join(field_descriptions)}\n"
+        "Handle variations in field names as indicated. For any field not found, use 'Not Found' as the value."
+    )
+
+@st.cache_data(show_spinner=False)
+def build_generation_config(selected_fields: tuple) -> dict:
+    # Force a JSON object with one string property per selected field, so the
+    # response never needs markdown stripping
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": {
+            "type": "OBJECT",
+            "properties": {field: {"type": "STRING"} for field in selected_fields},
+        },
+    }
+
+def extract_json(text: str) -> dict:
+    # The response schema should give bare JSON, but tolerate markdown fences or
+    # surrounding prose by decoding the first JSON object in the text
+    start = text.find("{")
+    if start == -1:
+        raise json.JSONDecodeError("No JSON object found", text, 0)
+    extracted_data, _ = json.JSONDecoder().raw_decode(text, start)
+    return extracted_data
+
+def extract_structured_data(client, file_path: str, file_hash: str, models: list, prompt: str, generation_config: dict, selected_fields: tuple, upload_cache: dict, text_future=None):
+    file_name = os.path.basename(file_path)
+    # Counted once per file: a hit only if no model tier needed an API call
+    used_api = False
+    try:
+        for i, model_name in enumerate(models):
+            last_model = i == len(models) - 1
+            response_text = None
+            try:
+                # Skip the API call entirely if this file was already extracted with the same settings
+                key = cache_key(file_hash, model_name, selected_fields)
+                extracted_data = response_cache.get(key)
+            
+                if extracted_data is None:
+                    used_api = True
+                    # Send the text layer when there is one; only scanned PDFs need uploading
+                    text = pdf_text_result(text_future)
+                    response = generate_with_retry(
+                        client,
+                        model_name,
+                        [
+                            prompt,
+                            text if text else get_uploaded_file(client, file_path, file_hash, upload_cache)
+                        ],
+                        generation_config=generation_config
+                    )
+                
+                    # Parse JSON response
+                    response_text = response.text
+                    extracted_data = extract_json(response_text)
+                    response_cache.set(key, extracted_data, expire=CACHE_TTL)
+            
+            except json.JSONDecodeError:
+                if last_model:
+                    return None, f"Failed to parse JSON response for {file_name}. Raw response: {response_text}"
+                logger.info("Unparseable response for %s from %s, trying the next model", file_name, model_name)
+                continue
+            except Exception as e:
+                return None, f"Error processing {file_name}: {str(e)}"
         
-    except json.JSONDecodeError:
-        st.error(f"Failed to parse JSON response for {os.path.basename(file_path)}. Raw response: {response_text}")
+            # A response with every field missing is treated as low confidence
+            if last_model or any(extracted_data.get(field, "Not Found") != "Not Found" for field in selected_fields):
+                return extracted_data, None
+            logger.info("No fields found for %s by %s, trying the next model", file_name, model_name)
+    finally:
+        with stats_lock:
+            stats["cache_misses" if used_api else "cache_hits"] += 1
+
+def needs_text(file_hash: str, models: list, selected_fields: tuple) -> bool:
+    # Walk the model tiers the way extract_structured_data does: the text layer is
+    # only needed if an uncached tier comes before the cached result it would accept
+    for i, model_name in enumerate(models):
+        extracted_data = response_cache.get(cache_key(file_hash, model_name, selected_fields))
+        if extracted_data is None:
+            return True
+        if i == len(models) - 1 or any(extracted_data.get(field, "Not Found") != "Not Found" for field in selected_fields):
+            return False
+    return False
+
+def make_text_executor(file_count: int):
+    # Text extraction is CPU-bound, so larger runs use worker processes. They are
+    # spawned rather than forked, since this process runs Streamlit and HTTP client threads.
+    if file_count < TEXT_POOL_MIN_FILES:
+        return ThreadPoolExecutor(max_workers=1)
+    workers = min(os.cpu_count() or 1, file_count)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+def submit_text_extraction(text_executor, file_paths: dict) -> dict:
+    # Map each key of file_paths to a future for the PDF's text layer. If the
+    # pool cannot take work, the files are simply uploaded instead.
+    text_futures = {}
+    for key, file_path in file_paths.items():
+        try:
+            text_futures[key] = text_executor.submit(extract_pdf_text, file_path)
+        except Exception as e:
+            logger.warning("Text extraction unavailable, uploading files instead: %s", e)
+            break
+    return text_futures
+
+def pdf_text_result(text_future):
+    # Wait for a file's text layer; a failed extraction (e.g. a broken process pool) falls back to upload
+    if text_future is None:
         return None
+    try:
+        return text_future.result()
     except Exception as e:
-        st.error(f"Error processing {os.path.basename(file_path)}: {str(e)}")
+        logger.warning("Text extraction failed, uploading the file instead: %s", e)
         return None
 
+@st.cache_resource
+def init_state_db():
+    # Create, migrate and prune the jobs table once per process rather than on
+    # every connection, since job state is looked up on every rerun
+    with closing(sqlite3.connect(STATE_DB)) as conn, conn:
+        primary_key = {row[1] for row in conn.execute("PRAGMA table_info(jobs)") if row[5]}
+        migrate = bool(primary_key) and "job_key" not in primary_key
+        if migrate:
+            # Older tables keyed rows by file only, so runs with other fields or models overwrote each other
+            conn.execute("ALTER TABLE jobs RENAME TO jobs_old")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "file_hash TEXT, filename TEXT, job_key TEXT, status TEXT, result_json TEXT, updated_at INTEGER, "
+            "PRIMARY KEY (file_hash, filename, job_key))"
+        )
+        if migrate:
+            conn.execute("INSERT OR IGNORE INTO jobs SELECT file_hash, filename, job_key, status, result_json, updated_at FROM jobs_old")
+            conn.execute("DROP TABLE jobs_old")
+        # Jobs are kept as long as cached responses, so the table does not grow without bound
+        conn.execute("DELETE FROM jobs WHERE updated_at < ?", (int(time.time()) - CACHE_TTL,))
+    return STATE_DB
+
+def open_state_db():
+    return sqlite3.connect(init_state_db())
+
+def uploaded_file_sha256(uploaded_file) -> str:
+    # Hash an upload in memory, once per session, so its recorded status can be looked up
+    upload_hashes = st.session_state.setdefault("upload_hashes", {})
+    if uploaded_file.file_id not in upload_hashes:
+        upload_hashes[uploaded_file.file_id] = hashlib.sha256(uploaded_file.getbuffer()).hexdigest()
+    return upload_hashes[uploaded_file.file_id]
+
+def load_job_state(job_keys: dict):
+    # job_keys maps each uploaded file name to (content hash, key of the current job).
+    # Only rows for exactly these files and settings are restored, so a session never
+    # sees files from other uploads, users or field sets.
+    processed_files, failed_files = [], []
+    with closing(open_state_db()) as conn:
+        for file_name, (file_hash, job_key) in job_keys.items():
+            row = conn.execute(
+                "SELECT status FROM jobs WHERE file_hash = ? AND filename = ? AND job_key = ?",
+                (file_hash, file_name, job_key)
+            ).fetchone()
+            if row and row[0] == "done":
+                processed_files.append(file_name)
+            elif row and row[0] == "failed":
+                failed_files.append(file_name)
+    return processed_files, failed_files
+
+def load_done_jobs(conn, job_keys: dict) -> dict:
+    # job_keys maps content hash to the key of the current job; returns {hash: result}
+    # for files already extracted with the same fields, model and prompt version
+    done = {}
+    for file_hash, job_key in job_keys.items():
+        row = conn.execute(
+            "SELECT result_json FROM jobs WHERE file_hash = ? AND job_key = ? AND status = 'done' LIMIT 1",
+            (file_hash, job_key)
+        ).fetchone()
+        if row:
+            done[file_hash] = json.loads(row[0])
+    return done
+
+def record_job(conn, file_hash: str, file_names: list, job_key: str, extracted_data):
+    status = "done" if extracted_data else "failed"
+    result_json = json.dumps(extracted_data) if extracted_data else None
+    now = int(time.time())
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO jobs (file_hash, filename, job_key, status, result_json, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            [(file_hash, file_name, job_key, status, result_json, now) for file_name in file_names]
+        )
+
+def save_uploaded_file(uploaded_file, file_path: str) -> str:
+    uploaded_file.seek(0)
+    with open(file_path, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, COPY_CHUNK_SIZE)
+    return file_path
+
+def group_uploads(uploaded_files: dict) -> dict:
+    # Map each content hash to the names of all uploads with that content, so
+    # duplicate PDFs uploaded under different names are only sent to Gemini once
+    hash_to_names = defaultdict(list)
+    for file_name, uploaded_file in uploaded_files.items():
+        hash_to_names[uploaded_file_sha256(uploaded_file)].append(file_name)
+    return hash_to_names
+
+def save_and_extract(client, uploaded_file, file_path: str, file_hash: str, models: list, prompt: str, generation_config, selected_fields: tuple, upload_cache: dict, text_executor, read_text: bool):
+    # Worker for extract_in_parallel: write one upload to disk, start reading its
+    # text layer if any model tier may still need it, then extract its data
+    save_uploaded_file(uploaded_file, file_path)
+    text_future = submit_text_extraction(text_executor, {file_hash: file_path}).get(file_hash) if read_text else None
+    return extract_structured_data(client, file_path, file_hash, models, prompt, generation_config, selected_fields, upload_cache, text_future)
+
+def prepare_batch_part(client, uploaded_file, file_path: str, file_hash: str, upload_cache: dict, text_executor) -> dict:
+    # Worker for extract_in_batch: write one upload to disk and return its request
+    # part, the PDF's text layer where available or else an uploaded copy
+    save_uploaded_file(uploaded_file, file_path)
+    text = pdf_text_result(submit_text_extraction(text_executor, {file_hash: file_path}).get(file_hash))
+    if text:
+        return {"text": text}
+    gemini_file = get_uploaded_file(client, file_path, file_hash, upload_cache)
+    return {"file_data": {"file_uri": gemini_file.uri, "mime_type": gemini_file.mime_type}}
+
+def extract_in_parallel(client, uploaded_files: dict, temp_dir: str, models: list, prompt: str, selected_fields: tuple, upload_cache: dict, max_workers: int, progress_bar, status_text):
+    # Gemini calls are network-bound, so run them on a thread pool. Workers must not
+    # touch Streamlit elements; errors are returned and reported from the main thread.
+    # uploaded_files maps the display name of each file to its Streamlit upload and
+    # models lists the chosen model name followed by its fallbacks. Each distinct PDF
+    # is saved under temp_dir and submitted as soon as its hash is known. Yields
+    # (file name, extracted data or None) pairs as each file finishes.
+    total = len(uploaded_files)
+    hash_to_names = defaultdict(list)
+    done_jobs = {}
+    futures = {}
+    done = 0
+    generation_config = build_generation_config(selected_fields)
+    
+    # Shut down without waiting if the run is abandoned (a Streamlit rerun or the
+    # generator being closed), so files still queued are not sent to Gemini
+    text_executor = make_text_executor(total)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    with closing(open_state_db()) as conn:
+        try:
+            for file_name, uploaded_file in uploaded_files.items():
+                file_hash = uploaded_file_sha256(uploaded_file)
+                hash_to_names[file_hash].append(file_name)
+                if file_hash in done_jobs:
+                    done += 1
+                    yield file_name, done_jobs[file_hash]
+                    continue
+                if len(hash_to_names[file_hash]) > 1:
+                    # Same content as a file already submitted; reported with its future
+                    continue
+                
+                # Files finished by an earlier, possibly interrupted, run are not sent again
+                job_key = cache_key(file_hash, models[0], selected_fields)
+                extracted_data = load_done_jobs(conn, {file_hash: job_key}).get(file_hash)
+                if extracted_data is not None:
+                    done_jobs[file_hash] = extracted_data
+                    done += 1
+                    yield file_name, extracted_data
+                    continue
+                
+                # Read the text layer in the background only if a model tier (escalation
+                # included) will still call the API for this file
+                file_path = os.path.join(temp_dir, f"{file_hash}.pdf")
+                future = executor.submit(save_and_extract, client, uploaded_file, file_path, file_hash, models, prompt, generation_config, selected_fields, upload_cache, text_executor, needs_text(file_hash, models, selected_fields))
+                futures[future] = file_hash
+            
+            for future in as_completed(futures):
+                file_hash = futures[future]
+                file_names = hash_to_names[file_hash]
+                extracted_data, error = future.result()
+                if error:
+                    st.error(error)
+                record_job(conn, file_hash, file_names, cache_key(file_hash, models[0], selected_fields), extracted_data)
+                
+                # Update progress
+                done += len(file_names)
+                progress_bar.progress(int(done / total * 100))
+                status_text.text(f"Processed {done} of {total}: {', '.join(file_names)}")
+                for file_name in file_names:
+                    yield file_name, extracted_data
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            text_executor.shutdown(wait=False, cancel_futures=True)
+
+def extract_in_batch(client, uploaded_files: dict, temp_dir: str, model_name: str, prompt: str, selected_fields: tuple, upload_cache: dict, max_workers: int, progress_bar, status_text):
+    # Submit all cache misses as a single Gemini Batch API job. Returns a
+    # {file name: extracted data or None} mapping once the job has finished.
+    extracted = {}
+    pending = {}
+    hash_to_names = group_uploads(uploaded_files)
+    job_keys = {file_hash: cache_key(file_hash, model_name, selected_fields) for file_hash in hash_to_names}
+    with closing(open_state_db()) as conn:
+        done_jobs = load_done_jobs(conn, job_keys)
+    for file_hash, file_names in hash_to_names.items():
+        key = job_keys[file_hash]
+        # Files finished by an earlier, possibly interrupted, run count like cache hits
+        cached = done_jobs.get(file_hash) or response_cache.get(key)
+        with stats_lock:
+            stats["cache_hits" if cached is not None else "cache_misses"] += 1
+        if cached is not None:
+            for file_name in file_names:
+                extracted[file_name] = cached
+        else:
+            pending[file_hash] = (uploaded_files[file_names[0]], key, file_names)
+    if not pending:
+        return extracted
+    
+    job = None
+    try:
+        # Save one copy of each PDF and send its text layer where available, uploading
+        # the rest; files are prepared concurrently
+        status_text.text(f"Preparing {len(pending)} files...")
+        file_parts = {}
+        with make_text_executor(len(pending)) as text_executor, ThreadPoolExecutor(max_workers=max_workers) as executor:
+            parts = {
+                file_hash: executor.submit(prepare_batch_part, client, uploaded_file, os.path.join(temp_dir, f"{file_hash}.pdf"), file_hash, upload_cache, text_executor)
+                for file_hash, (uploaded_file, _, _) in pending.items()
+            }
+            for file_hash, future in parts.items():
+                file_names = pending[file_hash][2]
+                try:
+                    file_parts[file_hash] = future.result()
+                except Exception as e:
+                    st.error(f"Error uploading {', '.join(file_names)}: {str(e)}")
+                    for file_name in file_names:
+                        extracted[file_name] = None
+        if not file_parts:
+            return extracted
+    
+        # One GenerateContentRequest per line, keyed by content hash
+        generation_config = build_generation_config(selected_fields)
+        with tempfile.NamedTemporaryFile("w", delete=False, suffix=".jsonl") as requests_file:
+            for file_hash, file_part in file_parts.items():
+                request = {
+                    "key": file_hash,
+                    "request": {
+                        "contents": [{
+                            "role": "user",
+                            "parts": [{"text": prompt}, file_part],
+                        }],
+                        "generation_config": generation_config,
+                    },
+                }
+                requests_file.write(json.dumps(request) + "\n")
+            requests_path = requests_file.name
+    
+        retryer = make_retryer()
+        try:
+            src = retryer(client.files.upload, file=requests_path, config={"mime_type": "jsonl"})
+        finally:
+            os.unlink(requests_path)
+        job = retryer(client.batches.create, model=model_name, src=src.name)
+        with stats_lock:
+            stats["api_calls"] += 1
+    
+        # Poll until the job finishes
+        start = time.monotonic()
+        while job.state.name not in BATCH_DONE_STATES:
+            elapsed = int(time.monotonic() - start)
+            status_text.text(f"Batch job {job.name} is {job.state.name} ({elapsed}s elapsed)...")
+            time.sleep(BATCH_POLL_INTERVAL)
+            job = retryer(client.batches.get, name=job.name)
+    
+        if job.state.name != "JOB_STATE_SUCCEEDED":
+            st.error(f"Batch job {job.name} ended with state {job.state.name}")
+            for file_hash in file_parts:
+                for file_name in pending[file_hash][2]:
+                    extracted[file_name] = None
+            return extracted
+    
+        # Parse the output JSONL; each line echoes the key of its request
+        output = retryer(client.files.download, file=job.dest.file_name).decode("utf-8")
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping malformed batch output line: %s", line[:200])
+                continue
+            file_hash = result.get("key") if isinstance(result, dict) else None
+            if file_hash not in pending:
+                continue
+            _, key, file_names = pending[file_hash]
+            extracted_data = None
+            response_text = None
+            try:
+                if "error" in result:
+                    raise RuntimeError(result["error"].get("message", result["error"]))
+                response_text = result["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                extracted_data = extract_json(response_text)
+                response_cache.set(key, extracted_data, expire=CACHE_TTL)
+            except json.JSONDecodeError:
+                st.error(f"Failed to parse JSON response for {', '.join(file_names)}. Raw response: {response_text}")
+            except Exception as e:
+                st.error(f"Error processing {', '.join(file_names)}: {str(e)}")
+            for file_name in file_names:
+                extracted[file_name] = extracted_data
+            progress_bar.progress(int(len(extracted) / len(uploaded_files) * 100))
+    
+        # Requests missing from the output count as failures
+        for file_hash in file_parts:
+            for file_name in pending[file_hash][2]:
+                extracted.setdefault(file_name, None)
+        progress_bar.progress(100)
+        return extracted
+    except Exception as e:
+        st.error(f"Batch extraction failed: {str(e)}")
+        for _, _, file_names in pending.values():
+            for file_name in file_names:
+                extracted.setdefault(file_name, None)
+        return extracted
+    finally:
+        # Don't leave a job running on Gemini once nobody is polling it (error or rerun)
+        if job is not None and job.state.name not in BATCH_DONE_STATES:
+            try:
+                client.batches.cancel(name=job.name)
+                logger.info("Cancelled unfinished batch job %s", job.name)
+            except Exception as e:
+                logger.warning("Could not cancel batch job %s: %s", job.name, e)
+        # Record the outcome of every file sent this run
+        with closing(open_state_db()) as conn:
+            for file_hash, (_, key, file_names) in pending.items():
+                record_job(conn, file_hash, file_names, key, extracted.get(file_names[0]))
+
 def main():
     st.set_page_config(page_title="PDF Data Extractor", layout="wide")
     st.title("Bulk PDF Data Extractor")
@@ -66,6 +623,8 @@ def main():
         st.session_state.processed_files = []
     if 'processing_complete' not in st.session_state:
         st.session_state.processing_complete = False
+    if 'uploaded_file_caches' not in st.session_state:
+        st.session_state.uploaded_file_caches = {}
 
     # Input for Gemini API key
     api_key = st.text_input("Enter your Gemini API Key", type="password")
@@ -73,14 +632,22 @@ def main():
         st.warning("Please enter a valid Gemini API Key to proceed.")
         return
 
+    # Model selection; larger models are only used as fallbacks
+    selected_model = st.selectbox("Model", MODEL_TIERS, index=0)
+
+    models = MODEL_TIERS[MODEL_TIERS.index(selected_model):]
+
     # Initialize Gemini client
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash")
+        client = get_client(api_key)
     except Exception as e:
         st.error(f"Invalid API key or error initializing Gemini: {str(e)}")
         return
 
+    # File API uploads belong to the key's project, so keep their handles per key
+    key_id = hashlib.sha256(api_key.encode()).hexdigest()
+    upload_cache = st.session_state.uploaded_file_caches.setdefault(key_id, {})
+
     # Multi-select for field selection
     st.write("Select the fields to extract from PDFs:")
     selected_fields = st.multiselect(
@@ -94,6 +661,10 @@ def main():
         st.warning("Please select at least one field to extract.")
         return
 
+    # Build the prompt once per field set and reuse it for every file
+    selected_fields = tuple(selected_fields)
+    prompt = build_prompt(selected_fields)
+
     # Multi-file uploader
     uploaded_files = st.file_uploader(
         "Upload multiple PDF files",
@@ -104,122 +675,148 @@ def main():
     if uploaded_files:
         st.success(f"Selected {len(uploaded_files)} PDF files for processing")
 
+    # Until this session has run, restore what an earlier (possibly interrupted)
+    # session recorded for the same uploads, fields and model
+    if uploaded_files and not st.session_state.processing_complete:
+        job_keys = {}
+        for uploaded_file in uploaded_files:
+            file_hash = uploaded_file_sha256(uploaded_file)
+            job_keys[uploaded_file.name] = (file_hash, cache_key(file_hash, models[0], selected_fields))
+        st.session_state.processed_files, st.session_state.failed_files = load_job_state(job_keys)
+        st.session_state.processing_complete = bool(st.session_state.failed_files)
+
+    # Number of files sent to Gemini at once; lower it to stay within the API rate limit
+    concurrency = st.slider("Concurrency", min_value=1, max_value=MAX_CONCURRENCY, value=8)
+    batch_mode = st.toggle(
+        "Batch mode",
+        help=f"Submit runs of {BATCH_MIN_FILES} or more files as one Gemini Batch API job. "
+             "Costs about half as much, but results can take a long time to arrive."
+    )
+
     # Process button
     if st.button("Extract Data") and uploaded_files and api_key and selected_fields:
         st.session_state.processing_complete = False
-        results = []
         st.session_state.failed_files = []
+        success_count = 0
         
         # Create a progress bar
         progress_bar = st.progress(0)
         status_text = st.empty()
+        live_table = st.empty()
         
-        # Create a temporary directory for uploaded files
+        # Create a temporary directory for uploaded files; each distinct PDF is
+        # written there by the worker that processes it
         with tempfile.TemporaryDirectory() as temp_dir:
-            # Save uploaded files to temp directory
-            saved_files = []
-            for i, uploaded_file in enumerate(uploaded_files):
-                file_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(file_path, "wb") as f:
-                    f.write(uploaded_file.getbuffer())
-                saved_files.append(file_path)
+            # (a later upload with the same name replaces an earlier one, as before)
+            uploaded_by_name = {uploaded_file.name: uploaded_file for uploaded_file in uploaded_files}
             
-            # Process each file
-            for i, file_path in enumerate(saved_files):
-                file_name = os.path.basename(file_path)
-                
-                # Update progress
-                progress = int((i + 1) / len(saved_files) * 100)
-                progress_bar.progress(progress)
-                status_text.text(f"Processing {i+1} of {len(saved_files)}: {file_name}")
-                
-                # Process the file
-                extracted_data = extract_structured_data(file_path, model, selected_fields)
-                
-                if extracted_data:
-                    # Create a row with file name and only selected fields
-                    row = {"File Name": file_name}
-                    for field in selected_fields:
-                        row[field] = extracted_data.get(field, "Not Found")
-                    results.append(row)
-                    st.session_state.processed_files.append(file_name)
-                else:
-                    st.session_state.failed_files.append(file_name)
+            # Process the files as a batch job, or concurrently for small runs
+            if batch_mode and len(uploaded_by_name) >= BATCH_MIN_FILES:
+                extracted = extract_in_batch(client, uploaded_by_name, temp_dir, models[0], prompt, selected_fields, upload_cache, concurrency, progress_bar, status_text).items()
+            else:
+                extracted = extract_in_parallel(client, uploaded_by_name, temp_dir, models, prompt, selected_fields, upload_cache, concurrency, progress_bar, status_text)
             
-            st.session_state.processing_complete = True
-        
-        # Display results after processing
-        if results:
-            # Convert results to DataFrame
-            df = pd.DataFrame(results)
+            # Write each row to CSV as soon as its file finishes
+            csv_path = os.path.join(temp_dir, "extracted_data.csv")
+            recent_rows = deque(maxlen=LIVE_PREVIEW_ROWS)
+            columns = ["File Name", *selected_fields]
+            unshown_rows = 0
+            last_preview = time.monotonic()
             
-            # Display results
-            st.write("Extracted Data:")
-            st.dataframe(df)
+            def refresh_preview():
+                nonlocal unshown_rows, last_preview
+                live_table.dataframe(pd.DataFrame.from_records(recent_rows, columns=columns))
+                unshown_rows = 0
+                last_preview = time.monotonic()
             
-            # Save to CSV
-            csv_data = df.to_csv(index=False).encode("utf-8")
-            st.download_button(
-                label="Download Data as CSV",
-                data=csv_data,
-                file_name="extracted_data.csv",
-                mime="text/csv",
-                key="download-csv"
-            )
+            with open(csv_path, "w", newline="", encoding="utf-8") as csv_file:
+                writer = csv.DictWriter(csv_file, fieldnames=columns)
+                writer.writeheader()
+                try:
+                    for file_name, extracted_data in extracted:
+                        if extracted_data:
+                            # Create a row with file name and only selected fields
+                            row = {"File Name": file_name, **{field: extracted_data.get(field, "Not Found") for field in selected_fields}}
+                            writer.writerow(row)
+                            recent_rows.append(row)
+                            unshown_rows += 1
+                            if unshown_rows >= LIVE_PREVIEW_EVERY_ROWS or time.monotonic() - last_preview >= LIVE_PREVIEW_INTERVAL:
+                                refresh_preview()
+                            success_count += 1
+                            st.session_state.processed_files.append(file_name)
+                        else:
+                            st.session_state.failed_files.append(file_name)
+                finally:
+                    # Show the last rows written, including when the run stops part-way
+                    if unshown_rows:
+                        refresh_preview()
             
-            # Show success message with stats
-            success_rate = len(results)/len(uploaded_files)*100
-            st.success(f"Data extraction completed! Success rate: {success_rate:.1f}%")
+            st.session_state.processing_complete = True
+            live_table.empty()
             
-            # Show failed files if any
-            if st.session_state.failed_files:
-                st.warning(f"Failed to process {len(st.session_state.failed_files)} files:")
-                st.write(st.session_state.failed_files)
-        else:
-            st.error("No data extracted from the provided PDFs.")
+            # Display results after processing
+            if success_count:
+                # Load the results back as strings so values like invoice numbers keep leading zeros
+                df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+                
+                # Display results
+                st.write("Extracted Data:")
+                st.dataframe(df)
+                
+                # Offer the CSV file directly instead of re-encoding the DataFrame
+                with open(csv_path, "rb") as csv_file:
+                    st.download_button(
+                        label="Download Data as CSV",
+                        data=csv_file,
+                        file_name="extracted_data.csv",
+                        mime="text/csv",
+                        key="download-csv"
+                    )
+                
+                # Show success message with stats
+                success_rate = success_count/len(uploaded_by_name)*100
+                st.success(f"Data extraction completed! Success rate: {success_rate:.1f}%")
+                
+                # Show failed files if any
+                if st.session_state.failed_files:
+                    st.warning(f"Failed to process {len(st.session_state.failed_files)} files:")
+                    st.write(st.session_state.failed_files)
+            else:
+                st.error("No data extracted from the provided PDFs.")
 
-    # Reprocess failed files button
-    if st.session_state.failed_files and st.session_state.processing_complete and st.button("Reprocess Failed Files"):
-        with st.spinner(f"Reprocessing {len(st.session_state.failed_files)} failed files..."):
+    # Reprocess failed files button, shown only when the failed files are still uploaded
+    uploaded_by_name = {uploaded_file.name: uploaded_file for uploaded_file in uploaded_files or []}
+    reprocessable = [file_name for file_name in st.session_state.failed_files if file_name in uploaded_by_name]
+    if reprocessable and st.session_state.processing_complete and st.button("Reprocess Failed Files"):
+        with st.spinner(f"Reprocessing {len(reprocessable)} failed files..."):
             results = []
-            new_failures = []
             
             # Create a progress bar for reprocessing
             reprocess_bar = st.progress(0)
             reprocess_status = st.empty()
             
-            for i, file_name in enumerate(st.session_state.failed_files):
-                # Update progress
-                progress = int((i + 1) / len(st.session_state.failed_files) * 100)
-                reprocess_bar.progress(progress)
-                reprocess_status.text(f"Reprocessing {i+1} of {len(st.session_state.failed_files)}: {file_name}")
+            # Failed files that are no longer uploaded stay failed
+            new_failures = [file_name for file_name in st.session_state.failed_files if file_name not in uploaded_by_name]
+            
+            with tempfile.TemporaryDirectory() as temp_dir:
+                extracted = dict(extract_in_parallel(client, {file_name: uploaded_by_name[file_name] for file_name in reprocessable}, temp_dir, models, prompt, selected_fields, upload_cache, concurrency, reprocess_bar, reprocess_status))
+            
+            for file_name in reprocessable:
+                extracted_data = extracted[file_name]
                 
-                # Find the file in uploaded files
-                for uploaded_file in uploaded_files:
-                    if uploaded_file.name == file_name:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                            tmp_file.write(uploaded_file.getbuffer())
-                            tmp_path = tmp_file.name
-                        
-                        extracted_data = extract_structured_data(tmp_path, model, selected_fields)
-                        os.unlink(tmp_path)
-                        
-                        if extracted_data:
-                            row = {"File Name": file_name}
-                            for field in selected_fields:
-                                row[field] = extracted_data.get(field, "Not Found")
-                            results.append(row)
-                            st.session_state.processed_files.append(file_name)
-                        else:
-                            new_failures.append(file_name)
-                        break
+                if extracted_data:
+                    row = {"File Name": file_name, **{field: extracted_data.get(field, "Not Found") for field in selected_fields}}
+                    results.append(row)
+                    st.session_state.processed_files.append(file_name)
+                else:
+                    new_failures.append(file_name)
             
             # Update failed files list
             st.session_state.failed_files = new_failures
             
             if results:
                 # Convert results to DataFrame
-                df = pd.DataFrame(results)
+                df = pd.DataFrame.from_records(results, columns=["File Name", *selected_fields])
                 
                 # Display results
                 st.write("Reprocessed Data:")
@@ -233,5 +830,13 @@ def main():
             else:
                 st.error("No additional files were successfully processed.")
 
+    # API usage stats
+    st.sidebar.subheader("Gemini API")
+    with stats_lock:
+        st.sidebar.metric("API calls", stats["api_calls"])
+        st.sidebar.metric("Retries", stats["retries"])
+        st.sidebar.metric("Cache hits", stats["cache_hits"])
+        st.sidebar.metric("Cache misses", stats["cache_misses"])
+
 if __name__ == "__main__":
     main()
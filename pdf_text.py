@@ -0,0 +1,14 @@
+from PyPDF2 import PdfReader
+
+# PDFs whose text layer yields fewer characters than this (e.g. scans) are uploaded instead
+MIN_TEXT_CHARS = 200
+
+# Kept out of app.py so spawned worker processes can import it without Streamlit
+def extract_pdf_text(file_path: str):
+    # Read the PDF's text layer locally; returns None if it has to be uploaded instead
+    try:
+        reader = PdfReader(file_path)
+        text = "\n".join(page.extract_text() or "" for page in reader.pages).strip()
+    except Exception:
+        return None
+    return text if len(text) >= MIN_TEXT_CHARS else None